@@ -47,15 +47,34 @@ The following attributes are calculated:
 """
 
 
-from typing import Dict, List, Set
+from __future__ import annotations
+import os
+from typing import Dict, List, TYPE_CHECKING
+
+import numpy as np
+import pandas as pd
 
 from tm2py.components.component import Component
 from tm2py.logger import LogStartEnd
 from tm2py.emme.manager import EmmeScenario, EmmeNetwork
+from tm2py.emme.network import NetworkCalculator
+
+if TYPE_CHECKING:
+    from tm2py.controller import RunController
+
+NumpyArray = np.array
 
 
 class PrepareNetwork(Component):
-    """Highway network preparation"""
+    """Highway network preparation
+
+    Args:
+        controller: parent RunController object
+    """
+
+    def __init__(self, controller: RunController):
+        super().__init__(controller)
+        self._toll_index = None
 
     @LogStartEnd("prepare network attributes and modes")
     def run(self):
@@ -72,15 +91,33 @@ class PrepareNetwork(Component):
                 self._set_tolls(network, time)
                 self._set_vdf_attributes(network, time)
                 self._set_link_modes(network)
-                self._calc_link_skim_lengths(network)
-                self._calc_link_class_costs(network)
                 scenario.publish_network(network)
+                # the skim length and class cost calculations run in-place
+                # on the scenario (emmebank) and do not need the network object
+                self._calc_link_skim_lengths(scenario)
+                self._calc_link_class_costs(scenario)
+
+    def validate_inputs(self):
+        """Validate the toll reference file exists and has the expected columns."""
+        toll_file_path = self.get_abs_path(self.config.highway.tolls.file_path)
+        if not os.path.exists(toll_file_path):
+            raise Exception(
+                f"highway.tolls.file_path does not exist {toll_file_path}"
+            )
+        with open(toll_file_path, "r", encoding="UTF8") as toll_file:
+            header = set(next(toll_file).strip().split(","))
+        required_columns = {"fac_index"}
+        for time in self.time_period_names():
+            for src_veh in self.config.highway.tolls.src_vehicle_group_names:
+                required_columns.add(f"toll{time.lower()}_{src_veh}")
+        missing = sorted(required_columns - header)
+        if missing:
+            raise Exception(
+                f"highway.tolls.file_path {toll_file_path} missing columns: {missing}"
+            )
 
     def _create_class_attributes(self, scenario: EmmeScenario, time_period: str):
         """Create required network attributes including per-class cost and flow attributes."""
-        create_attribute = self.controller.emme_manager.tool(
-            "inro.emme.data.extra_attribute.create_extra_attribute"
-        )
         attributes = {
             "LINK": [
                 ("@capacity", "total link capacity"),
@@ -114,55 +151,117 @@ class PrepareNetwork(Component):
                     f'{time_period} {assign_class["description"]} link volume'[:40],
                 )
             )
+        # create (or reset) the attributes directly on the scenario in one pass,
+        # avoiding the overhead of the create_extra_attribute tool per attribute
         for domain, attrs in attributes.items():
             for name, desc in attrs:
-                create_attribute(domain, name, desc, overwrite=True, scenario=scenario)
+                attribute = scenario.extra_attribute(name)
+                if attribute is None:
+                    attribute = scenario.create_extra_attribute(domain, name)
+                else:
+                    attribute.initialize()
+                attribute.description = desc
 
     def _set_tolls(self, network: EmmeNetwork, time_period: str):
         """Set the tolls in the network from the toll reference file."""
-        toll_index = self._get_toll_indices()
+        toll_table = self._get_toll_indices()
         src_veh_groups = self.config.highway.tolls.src_vehicle_group_names
         dst_veh_groups = self.config.highway.tolls.dst_vehicle_group_names
         tollbooth_start_index = self.config.highway.tolls.tollbooth_start_index
-        for link in network.links():
-            if link["@tollbooth"]:
-                index = (
-                    link["@tollbooth"] * 1000
-                    + link["@tollseg"] * 10
-                    + link["@useclass"]
-                )
-                data_row = toll_index.get(index)
-                if data_row is None:
+        values = self._get_link_values(
+            network, ["@tollbooth", "@tollseg", "@useclass", "length"]
+        )
+        tollbooth = values["@tollbooth"].astype(np.int64)
+        # lookup index in the toll table as tollbooth-tollseg-useclass
+        index = (
+            tollbooth * 1000
+            + values["@tollseg"].astype(np.int64) * 10
+            + values["@useclass"].astype(np.int64)
+        )
+        # positional lookup of each link index in the toll table, -1 if not found
+        positions = toll_table.index.get_indexer(index)
+        found = positions >= 0
+        # links with a tollbooth but no matching row keep tolls at zero
+        missing = (tollbooth > 0) & ~found
+        if missing.any():
+            for link, miss, link_index in zip(
+                network.links(), missing.tolist(), index.tolist()
+            ):
+                if miss:
                     self.logger.log(
-                        f"set tolls failed index lookup {index}, link {link.id}",
+                        f"set tolls failed index lookup {link_index}, link {link.id}",
                         level="TRACE",
                     )
-                    continue  # tolls will remain at zero
-                # if index is below tollbooth start index then this is a bridge
-                # (point toll), available for all traffic assignment classes
-                if link["@tollbooth"] < tollbooth_start_index:
-                    for src_veh, dst_veh in zip(src_veh_groups, dst_veh_groups):
-                        link[f"@bridgetoll_{dst_veh}"] = (
-                            data_row[f"toll{time_period.lower()}_{src_veh}"] * 100
-                        )
-                else:  # else, this is a tollway with a per-mile charge
-                    for src_veh, dst_veh in zip(src_veh_groups, dst_veh_groups):
-                        link[f"@valuetoll_{dst_veh}"] = (
-                            data_row[f"toll{time_period.lower()}_{src_veh}"]
-                            * link.length
-                            * 100
-                        )
-
-    def _get_toll_indices(self) -> Dict[int, Dict[str, str]]:
-        """Get the mapping of toll lookup table from the toll reference file."""
-        toll_file_path = self.get_abs_path(self.config.highway.tolls.file_path)
+        # if tollbooth is below the start index then this is a bridge
+        # (point toll), available for all traffic assignment classes,
+        # else this is a tollway with a per-mile charge
+        is_bridge = (tollbooth > 0) & (tollbooth < tollbooth_start_index)
+        is_value = tollbooth >= tollbooth_start_index
+        length = values["length"]
+        rows = np.where(found, positions, 0)
+        time_period_lc = time_period.lower()
+        toll_columns = [f"toll{time_period_lc}_{src_veh}" for src_veh in src_veh_groups]
+        toll_value_table = toll_table[toll_columns].to_numpy(dtype="float32")
         tolls = {}
-        with open(toll_file_path, "r", encoding="UTF8") as toll_file:
-            header = next(toll_file).split(",")
-            for line in toll_file:
-                data = dict(zip(header, line.split(",")))
-                tolls[int(data["fac_index"])] = data
-        return tolls
+        for pos, dst_veh in enumerate(dst_veh_groups):
+            toll_values = np.where(found, toll_value_table[rows, pos], 0)
+            tolls[f"@bridgetoll_{dst_veh}"] = np.where(is_bridge, toll_values * 100, 0)
+            tolls[f"@valuetoll_{dst_veh}"] = np.where(
+                is_value, toll_values * length * 100, 0
+            )
+        # the toll attributes were just initialized to zero, so only the
+        # sparse subset of links with a toll needs to be written
+        self._set_link_values(network, tolls, mask=(is_bridge | is_value) & found)
+
+    @staticmethod
+    def _get_link_values(
+        network: EmmeNetwork, attr_names: List[str]
+    ) -> Dict[str, NumpyArray]:
+        """Get the link attribute values as numpy arrays in network link order.
+
+        All requested attributes are read in a single traversal of the links.
+
+        Emme stores extra attribute values in single precision, so float32
+        arrays are used for the intermediate calculations (halving the
+        working set) without loss relative to the stored values.
+        """
+        columns = [(name, []) for name in attr_names]
+        for link in network.links():
+            for name, values in columns:
+                values.append(link[name])
+        return {
+            name: np.asarray(values, dtype="float32") for name, values in columns
+        }
+
+    @staticmethod
+    def _set_link_values(
+        network: EmmeNetwork,
+        attr_values: Dict[str, NumpyArray],
+        mask: NumpyArray = None,
+    ):
+        """Set the link attribute values from arrays in network link order.
+
+        All attributes are written in a single traversal of the links. If a
+        boolean mask array is given only the links where the mask is True are
+        written; the other links keep their current values.
+        """
+        columns = [(name, values.tolist()) for name, values in attr_values.items()]
+        write_link = None if mask is None else mask.tolist()
+        for index, link in enumerate(network.links()):
+            if write_link is not None and not write_link[index]:
+                continue
+            for name, values in columns:
+                link[name] = values[index]
+
+    def _get_toll_indices(self) -> pd.DataFrame:
+        """Get the toll lookup table from the toll reference file, indexed by fac_index.
+
+        The parsed table is cached as it is reused for every time period.
+        """
+        if self._toll_index is None:
+            toll_file_path = self.get_abs_path(self.config.highway.tolls.file_path)
+            self._toll_index = pd.read_csv(toll_file_path).set_index("fac_index")
+        return self._toll_index
 
     def _set_vdf_attributes(self, network: EmmeNetwork, time_period: str):
         """Set capacity, VDF and critical speed on links"""
@@ -178,21 +277,51 @@ class PrepareNetwork(Component):
         }
         period_capacity_factor = tp_mapping[time_period]
         akcelik_vdfs = [3, 4, 5, 7, 8, 10, 11, 12, 13, 14]
-        for link in network.links():
-            cap_lanehour = capacity_map[link["@capclass"]]
-            link["@capacity"] = cap_lanehour * period_capacity_factor * link["@lanes"]
-            link.volume_delay_func = int(link["@ft"])
-            # re-mapping links with type 99 to type 7 "local road of minor importance"
-            if link.volume_delay_func == 99:
-                link.volume_delay_func = 7
-            # num_lanes not used directly, but set for reference
-            link.num_lanes = max(min(9.9, link["@lanes"]), 1.0)
-            if link.volume_delay_func in akcelik_vdfs and link["@free_flow_speed"] > 0:
-                dist = link.length
-                critical_speed = critical_speed_map[link["@capclass"]]
-                t_c = dist / critical_speed
-                t_o = dist / link["@free_flow_speed"]
-                link["@ja"] = 16 * (t_c - t_o) ** 2
+        values = self._get_link_values(
+            network, ["@capclass", "@lanes", "@ft", "@free_flow_speed", "length"]
+        )
+        capclass = values["@capclass"].astype(np.int64)
+        lanes = values["@lanes"]
+        # lookup tables indexed by capclass, nan marks missing entries
+        table_size = max(int(capclass.max(initial=0)), max(capacity_map, default=0)) + 1
+        cap_table = np.full(table_size, np.nan, dtype="float32")
+        for key, value in capacity_map.items():
+            cap_table[key] = value
+        critical_speed_table = np.full(table_size, np.nan, dtype="float32")
+        for key, value in critical_speed_map.items():
+            critical_speed_table[key] = value
+        cap_lanehour = cap_table[capclass]
+        if np.isnan(cap_lanehour).any():
+            missing = np.unique(capclass[np.isnan(cap_lanehour)]).tolist()
+            raise KeyError(
+                f"@capclass values missing capacity in highway.capclass_lookup: {missing}"
+            )
+        # re-mapping links with type 99 to type 7 "local road of minor importance"
+        vdf = np.where(values["@ft"].astype(np.int64) == 99, 7, values["@ft"]).astype(
+            np.int64
+        )
+        ja_links = np.isin(vdf, akcelik_vdfs) & (values["@free_flow_speed"] > 0)
+        critical_speed = critical_speed_table[capclass]
+        if np.isnan(critical_speed[ja_links]).any():
+            missing = np.unique(
+                capclass[ja_links & np.isnan(critical_speed)]
+            ).tolist()
+            raise KeyError(
+                f"@capclass values missing critical_speed in highway.capclass_lookup: "
+                f"{missing}"
+            )
+        t_c = values["length"] / np.where(ja_links, critical_speed, 1.0)
+        t_o = values["length"] / np.where(ja_links, values["@free_flow_speed"], 1.0)
+        self._set_link_values(
+            network,
+            {
+                "@capacity": cap_lanehour * period_capacity_factor * lanes,
+                "volume_delay_func": vdf,
+                # num_lanes not used directly, but set for reference
+                "num_lanes": np.clip(lanes, 1.0, 9.9),
+                "@ja": np.where(ja_links, 16 * (t_c - t_o) ** 2, 0),
+            },
+        )
 
     def _set_link_modes(self, network: EmmeNetwork):
         """Set the link modes based on the per-class 'excluded_links' set."""
@@ -204,10 +333,20 @@ class PrepareNetwork(Component):
             for assign_class in self.config.highway.classes
         }
         used_modes.add(network.mode(self.config.highway.maz_to_maz.mode_code))
-        for link in network.links():
-            link.modes -= used_modes
-            if link["@drive_link"]:
-                link.modes |= auto_mode
+        dst_veh_groups = self.config.highway.tolls.dst_vehicle_group_names
+        values = self._get_link_values(
+            network,
+            ["@drive_link", "@useclass"]
+            + [f"@valuetoll_{dst_veh}" for dst_veh in dst_veh_groups],
+        )
+        drive_link = values["@drive_link"] != 0
+        for index, link in enumerate(network.links()):
+            orig_modes = link.modes
+            modes = orig_modes - used_modes
+            if drive_link[index]:
+                modes |= auto_mode
+            if modes != orig_modes:
+                link.modes = modes
         for mode in used_modes:
             if mode is not None:
                 network.delete_mode(mode)
@@ -238,76 +377,72 @@ class PrepareNetwork(Component):
             mode.description = assign_class.name
             mode_excluded_links[mode.id] = assign_class.excluded_links
 
-        dst_veh_groups = self.config.highway.tolls.dst_vehicle_group_names
-        for link in network.links():
-            modes = set(m.id for m in link.modes)
+        useclass = values["@useclass"]
+        exclude_links_map = {
+            "is_sr": np.isin(useclass, [2, 3]),
+            "is_sr2": useclass == 2,
+            "is_sr3": useclass == 3,
+            "is_auto_only": np.isin(useclass, [2, 3, 4]),
+        }
+        for dst_veh in dst_veh_groups:
+            exclude_links_map[f"is_toll_{dst_veh}"] = (
+                values[f"@valuetoll_{dst_veh}"] > 0
+            )
+        maz_access_mode_id = maz_access_mode.id
+        # specialize the per-class exclusion criteria into one boolean
+        # "add this mode" mask per mode code: a link gets the mode when
+        # none of the excluded_links criteria apply
+        mode_criteria = [
+            (maz_access_mode_id, self.config.highway.maz_to_maz.excluded_links)
+        ]
+        mode_criteria.extend(mode_excluded_links.items())
+        mode_add_masks = []
+        for mode_code, excluded_links_criteria in mode_criteria:
+            add_mask = np.ones(drive_link.size, dtype=bool)
+            for criteria in excluded_links_criteria:
+                add_mask &= ~exclude_links_map[criteria]
+            mode_add_masks.append((mode_code, add_mask))
+        for index, link in enumerate(network.links()):
+            orig_mode_ids = {mode.id for mode in link.modes}
+            modes = set(orig_mode_ids)
             if link.i_node["@maz_id"] + link.j_node["@maz_id"] > 0:
-                modes.add(maz_access_mode.id)
-                link.modes = modes
+                modes.add(maz_access_mode_id)
+                if modes != orig_mode_ids:
+                    link.modes = modes
                 continue
-            if not link["@drive_link"]:
+            if not drive_link[index]:
                 continue
-            exclude_links_map = {
-                "is_sr": link["@useclass"] in [2, 3],
-                "is_sr2": link["@useclass"] == 2,
-                "is_sr3": link["@useclass"] == 3,
-                "is_auto_only": link["@useclass"] in [2, 3, 4],
-            }
-            for dst_veh in dst_veh_groups:
-                exclude_links_map[f"is_toll_{dst_veh}"] = (
-                    link[f"@valuetoll_{dst_veh}"] > 0
-                )
-            self._apply_exclusions(
-                self.config.highway.maz_to_maz.excluded_links,
-                maz_access_mode.id,
-                modes,
-                exclude_links_map,
-            )
-            for assign_class in self.config.highway.classes:
-                self._apply_exclusions(
-                    assign_class.excluded_links,
-                    assign_class.mode_code,
-                    modes,
-                    exclude_links_map,
-                )
-            link.modes = modes
-
-    @staticmethod
-    def _apply_exclusions(
-        excluded_links_criteria: List[str],
-        mode_code: str,
-        modes_set: Set[str],
-        link_values: Dict[str, bool],
-    ):
-        """Apply the exclusion criteria to set the link modes."""
-        for criteria in excluded_links_criteria:
-            if link_values[criteria]:
-                return
-        modes_set.add(mode_code)
+            for mode_code, add_mask in mode_add_masks:
+                if add_mask[index]:
+                    modes.add(mode_code)
+            if modes != orig_mode_ids:
+                link.modes = modes
 
-    def _calc_link_skim_lengths(self, network: EmmeNetwork):
+    def _calc_link_skim_lengths(self, scenario: EmmeScenario):
         """Calculate the length attributes used in the highway skims."""
         tollbooth_start_index = self.config.highway.tolls.tollbooth_start_index
-        for link in network.links():
-            # distance in hov lanes / facilities
-            if 2 <= link["@useclass"] <= 3:
-                link["@hov_length"] = link.length
-            else:
-                link["@hov_length"] = 0
-            # distance on non-bridge toll facilities
-            if link["@tollbooth"] > tollbooth_start_index:
-                link["@toll_length"] = link.length
-            else:
-                link["@toll_length"] = 0
-
-    def _calc_link_class_costs(self, network: EmmeNetwork):
+        net_calc = NetworkCalculator(scenario)
+        # distance in hov lanes / facilities
+        net_calc.add_calc("@hov_length", "0")
+        net_calc.add_calc("@hov_length", "length", "@useclass=2,3")
+        # distance on non-bridge toll facilities
+        net_calc.add_calc("@toll_length", "0")
+        net_calc.add_calc(
+            "@toll_length", "length", f"@tollbooth={tollbooth_start_index + 1},9999"
+        )
+        net_calc.run()
+
+    def _calc_link_class_costs(self, scenario: EmmeScenario):
         """Calculate the per-class link cost from the tolls and operating costs."""
+        net_calc = NetworkCalculator(scenario)
         for assign_class in self.config.highway.classes:
-            cost_attr = f"@cost_{assign_class.name.lower()}"
             op_cost = assign_class["operating_cost_per_mile"]
             toll_factor = assign_class.get("toll_factor")
             if toll_factor is None:
                 toll_factor = 1.0
-            for link in network.links():
-                toll_value = sum(link[toll_attr] for toll_attr in assign_class["toll"])
-                link[cost_attr] = link.length * op_cost + toll_value * toll_factor
+            tolls = " + ".join(assign_class["toll"])
+            expression = f"length * {op_cost}"
+            if tolls:
+                expression += f" + ({tolls}) * {toll_factor}"
+            net_calc.add_calc(f"@cost_{assign_class.name.lower()}", expression)
+        net_calc.run()